@@ -1,15 +1,30 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, send_from_directory
 from flask_cors import CORS
-from pymongo import MongoClient
-from bson import ObjectId
+from werkzeug.security import safe_join
+from werkzeug.http import is_resource_modified
+from werkzeug.wsgi import wrap_file
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure
+from pymongo.write_concern import WriteConcern
+from bson import ObjectId, encode as encode_bson
+from bson.errors import InvalidDocument
 import os
+import base64
+import json
+import re
+import secrets
+import shutil
 import subprocess
-import uuid
-from datetime import datetime
+from datetime import datetime, timezone
 import logging
 import signal
 import sys
+import threading
+import time
+from collections import OrderedDict
+from itertools import islice
 from dotenv import load_dotenv
+import orjson
 
 # Load environment variables from .env file
 load_dotenv()
@@ -29,24 +44,50 @@ CORS(app, origins=["http://localhost:3000", "http://127.0.0.1:3000", "http://loc
      allow_headers=["Content-Type", "Authorization"],
      methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"])
 
+def new_id():
+    """Random 12-character URL-safe ID for streams and in-memory overlays"""
+    return base64.urlsafe_b64encode(secrets.token_bytes(9)).decode('ascii')
+
+def json_response(obj, status=200):
+    """Serialize obj with orjson (much faster than the stdlib json jsonify uses)"""
+    try:
+        body = orjson.dumps(obj, default=str, option=orjson.OPT_NAIVE_UTC)
+    except orjson.JSONEncodeError:
+        # orjson rejects what the stdlib accepts (e.g. ints over 64 bits)
+        body = json.dumps(obj, default=str)
+    return app.response_class(body, status=status, mimetype='application/json')
+
 # MongoDB connection with Atlas support
 MONGO_URI = os.getenv('MONGO_URI', 'mongodb://localhost:27017/')
 logger.info(f"Connecting to MongoDB...")
 
 try:
-    # MongoDB Atlas requires retryWrites and w=majority for reliability
+    # Retryable writes for Atlas failovers. Overlay writes deliberately use
+    # w=1 without a journal wait (see overlays_writes below)
     client = MongoClient(
         MONGO_URI, 
         serverSelectionTimeoutMS=10000,
         connectTimeoutMS=10000,
         socketTimeoutMS=10000,
-        retryWrites=True
+        retryWrites=True,
+        # Sized for gunicorn's gthread workers (32 threads each): enough
+        # connections for every thread, a few kept warm between bursts
+        maxPoolSize=64,
+        minPoolSize=8,
+        # Compress wire traffic to Atlas; zlib is the fallback if zstd
+        # isn't available on either side
+        compressors='zstd,zlib',
+        appname='rtsp-overlay'
     )
     
     # Test connection
     client.admin.command('ping')
     db = client['rtsp_overlay_db']
     overlays_collection = db['overlays']
+    # Overlay writes only need the primary's acknowledgement, not a journal flush
+    overlays_writes = overlays_collection.with_options(
+        write_concern=WriteConcern(w=1, j=False)
+    )
     
     # Create indexes for better performance
     overlays_collection.create_index('created_at')
@@ -58,18 +99,30 @@ except Exception as e:
     logger.warning("⚠️  Using in-memory storage as fallback")
     db = None
     overlays_collection = None
+    overlays_writes = None
     USE_MONGODB = False
 
-# In-memory fallback storage
-in_memory_overlays = []
+# In-memory fallback storage, keyed by overlay _id in creation order
+in_memory_overlays = OrderedDict()
 
-# Store active streams
+# Store active streams (shared between request threads)
 active_streams = {}
+_streams_lock = threading.Lock()
+
+# How long start_stream waits to catch an FFmpeg process that exits at once
+STREAM_STARTUP_CHECK_SECONDS = 1.0
+
+# How often exited FFmpeg processes are removed from active_streams
+STREAM_REAP_INTERVAL_SECONDS = 5
 
 # Create streams directory
-STREAMS_DIR = os.path.join(os.path.dirname(__file__), 'streams')
+STREAMS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'streams')
 os.makedirs(STREAMS_DIR, exist_ok=True)
 
+def format_timestamp(dt):
+    """ISO-8601 UTC timestamp in MongoDB's $toString form (milliseconds, 'Z')"""
+    return dt.astimezone(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
 # Check ffmpeg availability
 def check_ffmpeg():
     try:
@@ -85,37 +138,181 @@ def check_ffmpeg():
 
 ffmpeg_available = check_ffmpeg()
 
+# H.264 encoders in order of preference, with low-latency settings
+HW_VIDEO_ENCODERS = [
+    ('h264_nvenc', ['-preset', 'p1', '-tune', 'ull', '-rc', 'cbr', '-zerolatency', '1']),
+    ('h264_qsv', ['-preset', 'veryfast', '-low_power', '1']),
+    ('h264_amf', ['-usage', 'ultralowlatency']),
+]
+SOFTWARE_VIDEO_ENCODER = ('libx264', ['-preset', 'ultrafast', '-tune', 'zerolatency'])
+
+def detect_video_encoder():
+    """Pick the fastest H.264 encoder that works on this machine"""
+    if not ffmpeg_available:
+        return SOFTWARE_VIDEO_ENCODER
+    
+    candidates = HW_VIDEO_ENCODERS + [SOFTWARE_VIDEO_ENCODER]
+    forced = os.getenv('FFMPEG_VCODEC')
+    if forced:
+        for name, opts in candidates:
+            if name == forced:
+                logger.info(f"Using video encoder from FFMPEG_VCODEC: {name}")
+                return name, opts
+        logger.warning(f"Unknown FFMPEG_VCODEC '{forced}', probing instead")
+    
+    try:
+        encoders = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE,
+                                  text=True,
+                                  check=True).stdout
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return SOFTWARE_VIDEO_ENCODER
+    
+    for name, opts in HW_VIDEO_ENCODERS:
+        if name not in encoders:
+            continue
+        # A listed encoder can still lack the GPU/driver, so encode one frame
+        try:
+            subprocess.run(['ffmpeg', '-hide_banner',
+                            '-f', 'lavfi', '-i', 'testsrc=size=256x256:rate=30',
+                            '-frames:v', '1', '-c:v', name, *opts,
+                            '-f', 'null', '-'],
+                           stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL,
+                           check=True,
+                           timeout=10)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            continue
+        logger.info(f"✅ Using hardware video encoder: {name}")
+        return name, opts
+    
+    logger.info("Using software video encoder: libx264")
+    return SOFTWARE_VIDEO_ENCODER
+
+VIDEO_ENCODER, VIDEO_ENCODER_OPTS = detect_video_encoder()
+
+# HLS packaging: 'mpegts' (.ts segments) or 'fmp4' (.m4s segments, LL-HLS)
+HLS_SEGMENT_TYPE = os.getenv('HLS_SEGMENT_TYPE', 'mpegts')
+
+# Start reading the source without buffering or long probing
+LOW_LATENCY_INPUT_ARGS = [
+    '-fflags', 'nobuffer',
+    '-flags', 'low_delay',
+    '-probesize', '32',
+    '-analyzeduration', '0'
+]
+
+def hls_output_args(stream_dir, hls_path):
+    """FFmpeg HLS muxer arguments: 1s segments, 3-segment live playlist"""
+    hls_flags = 'delete_segments+append_list+independent_segments+omit_endlist+program_date_time'
+    if HLS_SEGMENT_TYPE == 'fmp4':
+        segment_args = [
+            '-hls_segment_type', 'fmp4',
+            '-hls_fmp4_init_filename', 'init.mp4',
+            '-hls_segment_filename', os.path.join(stream_dir, 'segment_%03d.m4s')
+        ]
+        hls_flags += '+split_by_time'
+    else:
+        segment_args = ['-hls_segment_filename', os.path.join(stream_dir, 'segment_%03d.ts')]
+    
+    return [
+        '-f', 'hls',
+        '-hls_time', '1',
+        '-hls_list_size', '3',
+        '-hls_flags', hls_flags,
+        *segment_args,
+        '-y',  # Overwrite output files
+        hls_path
+    ]
+
+# FFmpeg writes its own log (FFREPORT), so no pipe or Python reader thread is
+# needed per stream. Logs live outside the public streams directory (they
+# contain the full command line, including RTSP credentials) and outlive it.
+FFMPEG_LOGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+os.makedirs(FFMPEG_LOGS_DIR, exist_ok=True)
+
+# Reports not written to for this long are deleted by the stream reaper
+FFMPEG_LOG_RETENTION_HOURS = float(os.getenv('FFMPEG_LOG_RETENTION_HOURS', '24'))
+
+def ffmpeg_log_path(stream_id):
+    """Path of the FFmpeg report for a stream"""
+    return os.path.join(FFMPEG_LOGS_DIR, f'{stream_id}.log')
+
+def prune_ffmpeg_logs():
+    """Delete FFmpeg reports older than FFMPEG_LOG_RETENTION_HOURS"""
+    cutoff = time.time() - FFMPEG_LOG_RETENTION_HOURS * 3600
+    try:
+        entries = os.scandir(FFMPEG_LOGS_DIR)
+    except OSError as e:
+        # e.g. the logs directory was removed; runs on the reaper thread,
+        # which must not die
+        logger.warning(f"Can't prune FFmpeg logs: {e}")
+        return
+    with entries:
+        for entry in entries:
+            try:
+                if entry.name.endswith('.log') and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+def start_ffmpeg(ffmpeg_cmd, stream_id):
+    """Start FFmpeg detached from our stdio, logging to FFMPEG_LOGS_DIR"""
+    # Running in the logs directory keeps the report path relative, avoiding
+    # FFREPORT's escaping rules for ':' and '\' in Windows paths
+    env = {**os.environ, 'FFREPORT': f'file={stream_id}.log:level=32'}
+    return subprocess.Popen(
+        ffmpeg_cmd,
+        cwd=FFMPEG_LOGS_DIR,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+
 # ==================== HEALTH CHECK ====================
+# Reuse the last MongoDB ping result for this long, so frequent load balancer
+# probes don't each cost a database round-trip
+HEALTH_CACHE_SECONDS = 5.0
+_health_cache = {'checked_at': float('-inf'), 'mongodb_error': None}
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Check backend health and dependencies"""
-    try:
+    mongodb_status = "disconnected"
+    if overlays_collection is not None:
+        now = time.monotonic()
+        if now - _health_cache['checked_at'] > HEALTH_CACHE_SECONDS:
+            try:
+                client.admin.command('ping')
+                _health_cache['mongodb_error'] = None
+            except Exception as e:
+                _health_cache['mongodb_error'] = str(e)
+            _health_cache['checked_at'] = now
+        
+        if _health_cache['mongodb_error'] is not None:
+            return json_response({
+                "status": "unhealthy",
+                "error": _health_cache['mongodb_error']
+            }, 500)
         mongodb_status = "connected"
-        if overlays_collection is not None:
-            client.admin.command('ping')
-        else:
-            mongodb_status = "disconnected"
-        
-        return jsonify({
-            "status": "healthy",
-            "mongodb": mongodb_status,
-            "ffmpeg": "available" if ffmpeg_available else "not found",
-            "active_streams": len(active_streams)
-        }), 200
-    except Exception as e:
-        return jsonify({
-            "status": "unhealthy",
-            "error": str(e)
-        }), 500
+    
+    return json_response({
+        "status": "healthy",
+        "mongodb": mongodb_status,
+        "ffmpeg": "available" if ffmpeg_available else "not found",
+        "active_streams": len(active_streams)
+    }, 200)
 
 # ==================== STREAM MANAGEMENT ====================
 @app.route('/api/stream/test', methods=['POST'])
 def start_test_stream():
     """Start a test stream using testsrc (FFmpeg built-in test pattern)"""
     if not ffmpeg_available:
-        return jsonify({"error": "FFmpeg not available"}), 500
+        return json_response({"error": "FFmpeg not available"}, 500)
     
-    stream_id = str(uuid.uuid4())
+    stream_id = new_id()
     stream_dir = os.path.join(STREAMS_DIR, stream_id)
     os.makedirs(stream_dir, exist_ok=True)
     
@@ -128,76 +325,66 @@ def start_test_stream():
         '-i', 'testsrc=duration=300:size=1280x720:rate=30',
         '-f', 'lavfi',
         '-i', 'sine=frequency=1000:duration=300',
-        '-c:v', 'libx264',
-        '-preset', 'ultrafast',
-        '-tune', 'zerolatency',
+        '-c:v', VIDEO_ENCODER,
+        *VIDEO_ENCODER_OPTS,
+        '-g', '30',  # One keyframe per 1s segment
         '-c:a', 'aac',
-        '-f', 'hls',
-        '-hls_time', '2',
-        '-hls_list_size', '10',
-        '-hls_flags', 'delete_segments+append_list',
-        '-hls_segment_filename', os.path.join(stream_dir, 'segment_%03d.ts'),
-        '-y',  # Overwrite output files
-        hls_path
+        *hls_output_args(stream_dir, hls_path)
     ]
     
     try:
         logger.info(f"Starting TEST stream with generated pattern")
         
-        process = subprocess.Popen(
-            ffmpeg_cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,  # Redirect stderr to stdout
-            universal_newlines=True
-        )
-        
-        active_streams[stream_id] = {
-            'process': process,
-            'rtsp_url': 'test://pattern',
-            'hls_path': hls_path,
-            'started_at': datetime.utcnow().isoformat()
-        }
-        
-        # Start a background thread to log FFmpeg output
-        def log_ffmpeg_output():
-            for line in process.stdout:
-                logger.info(f"[FFmpeg-TEST {stream_id[:8]}] {line.strip()}")
-        
-        import threading
-        log_thread = threading.Thread(target=log_ffmpeg_output, daemon=True)
-        log_thread.start()
+        process = start_ffmpeg(ffmpeg_cmd, stream_id)
+        
+        with _streams_lock:
+            active_streams[stream_id] = {
+                'process': process,
+                'rtsp_url': 'test://pattern',
+                'hls_path': hls_path,
+                'started_at': format_timestamp(datetime.now(timezone.utc))
+            }
         
         logger.info(f"🎥 Test stream started: {stream_id}")
+        logger.info(f"📝 FFmpeg log: {ffmpeg_log_path(stream_id)}")
         
-        return jsonify({
+        return json_response({
             'stream_id': stream_id,
             'hls_url': f'http://localhost:5000/streams/{stream_id}/index.m3u8',
+            'ready_url': f'http://localhost:5000/api/stream/{stream_id}/ready',
             'status': 'started',
             'message': 'Test stream started with generated pattern'
-        }), 200
+        }, 200)
         
     except Exception as e:
         logger.error(f"Error starting test stream: {e}")
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
 
 
 @app.route('/api/stream/start', methods=['POST'])
 def start_stream():
     """Start RTSP to HLS conversion"""
     if not ffmpeg_available:
-        return jsonify({"error": "FFmpeg not available"}), 500
+        return json_response({"error": "FFmpeg not available"}, 500)
     
     data = request.get_json()
     rtsp_url = data.get('rtsp_url')
     
     if not rtsp_url:
-        return jsonify({"error": "rtsp_url is required"}), 400
+        return json_response({"error": "rtsp_url is required"}, 400)
     
     if not rtsp_url.startswith('rtsp://'):
-        return jsonify({"error": "Invalid RTSP URL format"}), 400
+        return json_response({"error": "Invalid RTSP URL format"}, 400)
+    
+    # Pass the camera's video through untouched unless re-encoding is requested
+    if data.get('transcode'):
+        video_args = ['-c:v', VIDEO_ENCODER, *VIDEO_ENCODER_OPTS,
+                      '-force_key_frames', 'expr:gte(t,n_forced*1)']
+    else:
+        video_args = ['-c:v', 'copy']
     
     # Generate unique stream ID
-    stream_id = str(uuid.uuid4())
+    stream_id = new_id()
     stream_dir = os.path.join(STREAMS_DIR, stream_id)
     os.makedirs(stream_dir, exist_ok=True)
     
@@ -209,72 +396,68 @@ def start_stream():
         'ffmpeg',
         '-rtsp_transport', 'tcp',
         '-timeout', '10000000',  # 10 second timeout for RTSP connection
+        *LOW_LATENCY_INPUT_ARGS,
         '-i', rtsp_url,
-        '-c:v', 'copy',
+        *video_args,
         '-c:a', 'aac',
-        '-f', 'hls',
-        '-hls_time', '2',
-        '-hls_list_size', '10',
-        '-hls_flags', 'delete_segments+append_list',
-        '-hls_segment_filename', os.path.join(stream_dir, 'segment_%03d.ts'),
-        '-y',  # Overwrite output files
-        hls_path
+        *hls_output_args(stream_dir, hls_path)
     ]
     
     try:
         # Start FFmpeg process with better error capture
         logger.info(f"Starting FFmpeg with command: {' '.join(ffmpeg_cmd)}")
         
-        process = subprocess.Popen(
-            ffmpeg_cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,  # Redirect stderr to stdout
-            universal_newlines=True
-        )
+        process = start_ffmpeg(ffmpeg_cmd, stream_id)
         
         # Store stream info
-        active_streams[stream_id] = {
-            'process': process,
-            'rtsp_url': rtsp_url,
-            'hls_path': hls_path,
-            'started_at': datetime.utcnow().isoformat()
-        }
-        
-        # Start a background thread to log FFmpeg output
-        def log_ffmpeg_output():
-            for line in process.stdout:
-                logger.info(f"[FFmpeg {stream_id[:8]}] {line.strip()}")
-        
-        import threading
-        log_thread = threading.Thread(target=log_ffmpeg_output, daemon=True)
-        log_thread.start()
+        with _streams_lock:
+            active_streams[stream_id] = {
+                'process': process,
+                'rtsp_url': rtsp_url,
+                'hls_path': hls_path,
+                'started_at': format_timestamp(datetime.now(timezone.utc))
+            }
         
         logger.info(f"🎥 Stream started: {stream_id} from {rtsp_url}")
         logger.info(f"📁 HLS output: {hls_path}")
+        logger.info(f"📝 FFmpeg log: {ffmpeg_log_path(stream_id)}")
         logger.info(f"⏳ Please wait 10-15 seconds for HLS segments to be created...")
         
-        # Check if process started successfully
-        import time
-        time.sleep(1)
+        # Check if process started successfully: wait up to 1s for an
+        # early exit, but return as soon as the playlist appears
+        deadline = time.monotonic() + STREAM_STARTUP_CHECK_SECONDS
+        while time.monotonic() < deadline:
+            if process.poll() is not None or os.path.exists(hls_path):
+                break
+            time.sleep(0.05)
+        
         if process.poll() is not None:
             # Process already terminated - there was an error
-            _, stderr = process.communicate()
-            logger.error(f"FFmpeg failed immediately: {stderr}")
-            return jsonify({
+            try:
+                with open(ffmpeg_log_path(stream_id), errors='replace') as f:
+                    details = f.read()[-500:]
+            except OSError:
+                details = f"FFmpeg exited with code {process.returncode}"
+            logger.error(f"FFmpeg failed immediately: {details}")
+            with _streams_lock:
+                active_streams.pop(stream_id, None)
+            shutil.rmtree(stream_dir, ignore_errors=True)
+            return json_response({
                 "error": f"FFmpeg failed to start. Check RTSP URL or FFmpeg installation.",
-                "details": stderr[:500]
-            }), 500
+                "details": details
+            }, 500)
         
-        return jsonify({
+        return json_response({
             'stream_id': stream_id,
             'hls_url': f'http://localhost:5000/streams/{stream_id}/index.m3u8',
+            'ready_url': f'http://localhost:5000/api/stream/{stream_id}/ready',
             'status': 'started',
             'message': 'Stream started. Please wait 10-15 seconds for video to load.'
-        }), 200
+        }, 200)
         
     except Exception as e:
         logger.error(f"Error starting stream: {e}")
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
 
 @app.route('/api/stream/stop', methods=['POST'])
 @app.route('/api/stream/<stream_id>/stop', methods=['POST'])
@@ -284,30 +467,60 @@ def stop_stream(stream_id=None):
         data = request.get_json()
         stream_id = data.get('stream_id')
     
-    if not stream_id or stream_id not in active_streams:
-        return jsonify({"error": "Stream not found"}), 404
+    with _streams_lock:
+        info = active_streams.pop(stream_id, None) if stream_id else None
+    
+    if info is None:
+        return json_response({"error": "Stream not found"}, 404)
     
     try:
         # Terminate FFmpeg process
-        process = active_streams[stream_id]['process']
+        process = info['process']
         process.terminate()
-        process.wait(timeout=5)
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            # Stuck (e.g. on RTSP I/O); it's no longer tracked, so don't leave it running
+            logger.warning(f"FFmpeg did not exit, killing stream: {stream_id}")
+            process.kill()
+            process.wait()
         
-        # Clean up
-        del active_streams[stream_id]
         logger.info(f"🛑 Stream stopped: {stream_id}")
-        
-        return jsonify({"status": "stopped"}), 200
+        return json_response({"status": "stopped"}, 200)
         
     except Exception as e:
         logger.error(f"Error stopping stream: {e}")
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
+    finally:
+        # Stopped streams are no longer tracked, so the reaper won't see them
+        shutil.rmtree(os.path.join(STREAMS_DIR, stream_id), ignore_errors=True)
+
+@app.route('/api/stream/<stream_id>/ready', methods=['GET'])
+def stream_ready(stream_id):
+    """Report whether a stream's HLS playlist is available yet"""
+    with _streams_lock:
+        info = active_streams.get(stream_id)
+    
+    if info is None:
+        return json_response({"error": "Stream not found"}, 404)
+    
+    exit_code = info['process'].poll()
+    return json_response({
+        'stream_id': stream_id,
+        'running': exit_code is None,
+        'ready': exit_code is None and os.path.exists(info['hls_path']),
+        'exit_code': exit_code
+    }, 200)
 
 @app.route('/api/stream/status', methods=['GET'])
 def stream_status():
     """Get status of all active streams"""
+    # Snapshot under the lock; poll() the processes outside it
+    with _streams_lock:
+        snapshot = list(active_streams.items())
+    
     streams = []
-    for stream_id, info in active_streams.items():
+    for stream_id, info in snapshot:
         streams.append({
             'stream_id': stream_id,
             'rtsp_url': info['rtsp_url'],
@@ -315,58 +528,223 @@ def stream_status():
             'running': info['process'].poll() is None
         })
     
-    return jsonify({'active_streams': streams}), 200
+    return json_response({'active_streams': streams}, 200)
 
 # ==================== SERVE HLS STREAMS ====================
+HLS_MIME_TYPES = {
+    '.m3u8': 'application/vnd.apple.mpegurl',
+    '.ts': 'video/mp2t',
+    '.m4s': 'video/iso.segment',
+    '.mp4': 'video/mp4'
+}
+
+HLS_SEGMENT_EXTENSIONS = ('.ts', '.m4s')
+
+# When nginx fronts the app, hand file delivery back to it via X-Accel-Redirect
+# so segment bytes never pass through Python. Set to the internal location
+# that aliases the streams directory, e.g. "/_streams/" (see nginx.conf.example).
+HLS_ACCEL_REDIRECT_PREFIX = os.getenv('HLS_ACCEL_REDIRECT_PREFIX')
+
 @app.route('/streams/<stream_id>/<filename>', methods=['GET'])
 def serve_stream(stream_id, filename):
     """Serve HLS playlist and segments"""
-    stream_dir = os.path.join(STREAMS_DIR, stream_id)
+    # Only HLS files are public, and only from inside STREAMS_DIR
+    mimetype = HLS_MIME_TYPES.get(os.path.splitext(filename)[1])
+    stream_dir = safe_join(STREAMS_DIR, stream_id)
+    file_path = safe_join(STREAMS_DIR, stream_id, filename)
+    if mimetype is None or stream_dir is None or file_path is None:
+        return json_response({"error": "Stream not found"}, 404)
     
     if not os.path.exists(stream_dir):
         logger.error(f"Stream directory not found: {stream_dir}")
-        return jsonify({"error": "Stream not found"}), 404
+        return json_response({"error": "Stream not found"}, 404)
     
-    file_path = os.path.join(stream_dir, filename)
     if not os.path.exists(file_path):
         logger.warning(f"File not found yet: {file_path}")
-        return jsonify({"error": f"File {filename} not ready yet. Please wait..."}), 404
+        return json_response({"error": f"File {filename} not ready yet. Please wait..."}, 404)
+    
+    if HLS_ACCEL_REDIRECT_PREFIX:
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = f"{HLS_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{stream_id}/{filename}"
+    elif filename.endswith(HLS_SEGMENT_EXTENSIONS):
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            # Rotated out of the playlist since the exists() check
+            return json_response({"error": "Stream not found"}, 404)
+        
+        etag = f"{stat.st_mtime_ns:x}-{stat.st_size:x}"
+        last_modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+        if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+            # Answer revalidations before opening the file
+            response = Response(status=304)
+        else:
+            # Hand the open file to the server's wsgi.file_wrapper (sendfile(2)
+            # under gunicorn); otherwise stream it in 1 MiB reads
+            try:
+                segment = open(file_path, 'rb')
+            except FileNotFoundError:
+                return json_response({"error": "Stream not found"}, 404)
+            response = Response(
+                wrap_file(request.environ, segment, buffer_size=1 << 20),
+                mimetype=mimetype,
+                direct_passthrough=True
+            )
+            response.content_length = stat.st_size
+        response.set_etag(etag)
+        response.last_modified = last_modified
+        if response.status_code != 304:
+            # Answer Range requests with 206 partial content, as send_file does.
+            # An unsatisfiable range raises 416 before the body is ever sent.
+            try:
+                response.make_conditional(request.environ, accept_ranges=True,
+                                          complete_length=stat.st_size)
+            except Exception:
+                segment.close()
+                raise
+    else:
+        # send_from_directory already sets ETag/Last-Modified and answers 304s
+        response = send_from_directory(stream_dir, filename, mimetype=mimetype)
     
-    # Set proper content type
+    # Segments never change once written (each stream has its own directory);
+    # the playlist changes every segment and must always be revalidated
     if filename.endswith('.m3u8'):
-        return send_from_directory(stream_dir, filename, mimetype='application/vnd.apple.mpegurl')
-    elif filename.endswith('.ts'):
-        return send_from_directory(stream_dir, filename, mimetype='video/mp2t')
+        response.headers['Cache-Control'] = 'no-cache'
     else:
-        return send_from_directory(stream_dir, filename)
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+# ==================== OVERLAY WRITE-BEHIND ====================
+# Dragging/resizing an overlay sends a burst of PUTs. Updates are merged per
+# overlay and written to MongoDB in one bulk_write every flush interval.
+# Queues are keyed by the lowercase hex ID, the form $toString returns.
+OVERLAY_FLUSH_INTERVAL_SECONDS = 0.05
+_pending_overlay_updates = {}
+# Batch currently being written; still merged into reads until it lands
+_flushing_overlay_updates = {}
+_pending_lock = threading.Lock()
+
+def _requeue_overlay_updates(updates):
+    """Put unwritten updates back in the queue; fields queued since win"""
+    with _pending_lock:
+        for overlay_id, fields in updates:
+            _pending_overlay_updates[overlay_id] = {
+                **fields, **_pending_overlay_updates.get(overlay_id, {})
+            }
+
+def flush_overlay_updates():
+    """Write all queued overlay updates to MongoDB"""
+    global _pending_overlay_updates, _flushing_overlay_updates
+    with _pending_lock:
+        if not _pending_overlay_updates:
+            return
+        drained, _pending_overlay_updates = _pending_overlay_updates, {}
+        _flushing_overlay_updates = drained
+    
+    updates = list(drained.items())
+    ops = [UpdateOne({'_id': ObjectId(overlay_id)}, {'$set': fields})
+           for overlay_id, fields in updates]
+    try:
+        overlays_writes.bulk_write(ops, ordered=False)
+    except ConnectionFailure as e:
+        # Retry on the next flush ($set is idempotent)
+        logger.warning(f"Overlay flush failed, retrying {len(ops)} updates: {e}")
+        _requeue_overlay_updates(updates)
+    except BulkWriteError as e:
+        # Unordered, so every update except the failed ones was applied
+        logger.error(f"Dropped {len(e.details['writeErrors'])} overlay updates: {e}")
+    except Exception as e:
+        # The batch failed as a whole; write the updates one at a time so
+        # only the bad ones are dropped
+        logger.warning(f"Overlay flush failed, writing {len(ops)} updates one by one: {e}")
+        for i, (op, (overlay_id, _)) in enumerate(zip(ops, updates)):
+            try:
+                overlays_writes.bulk_write([op])
+            except ConnectionFailure:
+                _requeue_overlay_updates(updates[i:])
+                break
+            except Exception as e:
+                logger.error(f"Dropped update for overlay {overlay_id}: {e}")
+    finally:
+        with _pending_lock:
+            _flushing_overlay_updates = {}
+
+def _queued_fields(fields):
+    """Queued update fields as the API returns them (string timestamp)"""
+    # Only fields in OVERLAY_PROJECTION, so reads look the same before and
+    # after the flush
+    queued = {key: value for key, value in fields.items() if key in OVERLAY_PROJECTION}
+    queued['updated_at'] = format_timestamp(fields['updated_at'])
+    return queued
+
+def merge_pending_overlay_updates(overlays):
+    """Apply queued (not yet written) updates to overlays read from MongoDB"""
+    with _pending_lock:
+        if not (_pending_overlay_updates or _flushing_overlay_updates):
+            return
+        for overlay in overlays:
+            overlay_id = overlay['_id']
+            for queue in (_flushing_overlay_updates, _pending_overlay_updates):
+                if overlay_id in queue:
+                    overlay.update(_queued_fields(queue[overlay_id]))
+
+def overlay_flush_loop():
+    """Background loop: flush queued overlay updates"""
+    while True:
+        time.sleep(OVERLAY_FLUSH_INTERVAL_SECONDS)
+        flush_overlay_updates()
+
+if USE_MONGODB:
+    threading.Thread(target=overlay_flush_loop, daemon=True).start()
 
 # ==================== OVERLAY CRUD ====================
+# Fields returned for overlays (the frontend saves drag/resize results as
+# top-level x/y/width/height). The server converts the ObjectId and dates to
+# strings, so documents come back JSON-ready (MongoDB 4.4+).
+OVERLAY_PROJECTION = {
+    '_id': {'$toString': '$_id'},
+    'type': 1, 'content': 1, 'position': 1, 'size': 1,
+    'x': 1, 'y': 1, 'width': 1, 'height': 1, 'stream_id': 1,
+    'created_at': {'$toString': '$created_at'},
+    'updated_at': {'$toString': '$updated_at'}
+}
+
+# 24-hex-digit MongoDB ObjectId, checked before building ObjectId().
+# Anchored with \Z because $ would also accept a trailing newline.
+_OID_RE = re.compile(r'^[0-9a-fA-F]{24}\Z')
+
+# Maximum overlay IDs per delete_many command in bulk delete
+BULK_DELETE_CHUNK_SIZE = 5000
+
 @app.route('/api/overlays', methods=['GET'])
 def get_overlays():
-    """Get all overlays"""
+    """Get overlays, newest first (optional ?limit= and ?skip= paging)"""
+    limit = request.args.get('limit', 0, type=int)
+    skip = request.args.get('skip', 0, type=int)
+    if limit < 0 or skip < 0:
+        return json_response({"error": "limit and skip must be non-negative"}, 400)
+    
     if USE_MONGODB:
         if overlays_collection is None:
-            return jsonify({"error": "Database not available"}), 503
+            return json_response({"error": "Database not available"}, 503)
         
         try:
-            overlays = list(overlays_collection.find().sort('created_at', -1))
-            for overlay in overlays:
-                overlay['_id'] = str(overlay['_id'])
-                # Convert datetime to string if needed
-                if 'created_at' in overlay and hasattr(overlay['created_at'], 'isoformat'):
-                    overlay['created_at'] = overlay['created_at'].isoformat()
-                if 'updated_at' in overlay and hasattr(overlay['updated_at'], 'isoformat'):
-                    overlay['updated_at'] = overlay['updated_at'].isoformat()
+            # The created_at index serves this sort in either direction
+            cursor = overlays_collection.find({}, OVERLAY_PROJECTION) \
+                .sort('created_at', -1).skip(skip).limit(limit)
+            overlays = list(cursor)
+            merge_pending_overlay_updates(overlays)
             
             logger.info(f"📋 Retrieved {len(overlays)} overlays")
-            return jsonify(overlays), 200
+            return json_response(overlays, 200)
             
         except Exception as e:
             logger.error(f"Error fetching overlays: {e}")
-            return jsonify({"error": str(e)}), 500
+            return json_response({"error": str(e)}, 500)
     else:
-        # Return in-memory overlays
-        return jsonify(in_memory_overlays), 200
+        # Return in-memory overlays, newest first like the MongoDB path
+        end = skip + limit if limit else None
+        return json_response(list(islice(reversed(in_memory_overlays.values()), skip, end)), 200)
 
 @app.route('/api/overlays', methods=['POST'])
 def create_overlay():
@@ -375,10 +753,14 @@ def create_overlay():
     
     # Validate required fields
     if not data.get('type') or data['type'] not in ['text', 'image']:
-        return jsonify({"error": "Invalid overlay type. Must be 'text' or 'image'"}), 400
+        return json_response({"error": "Invalid overlay type. Must be 'text' or 'image'"}, 400)
     
     if not data.get('content'):
-        return jsonify({"error": "Content is required"}), 400
+        return json_response({"error": "Content is required"}, 400)
+    
+    # One timestamp for both fields and both storage paths
+    now = datetime.now(timezone.utc)
+    now_iso = format_timestamp(now)
     
     # Set defaults
     overlay = {
@@ -386,57 +768,59 @@ def create_overlay():
         'content': data['content'],
         'position': data.get('position', {'x': 50, 'y': 50}),
         'size': data.get('size', {'width': 200, 'height': 100}),
-        'created_at': datetime.utcnow().isoformat(),
-        'updated_at': datetime.utcnow().isoformat()
+        'created_at': now_iso,
+        'updated_at': now_iso
     }
     
     # Validate dimensions
     if overlay['size']['width'] < 10 or overlay['size']['width'] > 2000:
-        return jsonify({"error": "Width must be between 10 and 2000"}), 400
+        return json_response({"error": "Width must be between 10 and 2000"}, 400)
     if overlay['size']['height'] < 10 or overlay['size']['height'] > 2000:
-        return jsonify({"error": "Height must be between 10 and 2000"}), 400
+        return json_response({"error": "Height must be between 10 and 2000"}, 400)
     
     if USE_MONGODB:
         try:
             # Convert to datetime for MongoDB
-            mongo_overlay = overlay.copy()
-            mongo_overlay['created_at'] = datetime.utcnow()
-            mongo_overlay['updated_at'] = datetime.utcnow()
+            oid = ObjectId()
+            mongo_overlay = {**overlay, '_id': oid, 'created_at': now, 'updated_at': now}
+            overlay['_id'] = str(oid)
             
-            result = overlays_collection.insert_one(mongo_overlay)
-            overlay['_id'] = str(result.inserted_id)
+            overlays_writes.insert_one(mongo_overlay)
             
             logger.info(f"✅ Overlay created: {overlay['_id']} ({overlay['type']})")
-            return jsonify(overlay), 201
+            return json_response(overlay, 201)
             
         except Exception as e:
             logger.error(f"Error creating overlay: {e}")
-            return jsonify({"error": str(e)}), 500
+            return json_response({"error": str(e)}, 500)
     else:
         # Use in-memory storage
-        overlay['_id'] = str(uuid.uuid4())
-        in_memory_overlays.append(overlay)
+        overlay['_id'] = new_id()
+        in_memory_overlays[overlay['_id']] = overlay
         logger.info(f"✅ Overlay created (in-memory): {overlay['_id']} ({overlay['type']})")
-        return jsonify(overlay), 201
+        return json_response(overlay, 201)
 
 @app.route('/api/overlays/<overlay_id>', methods=['GET'])
 def get_overlay(overlay_id):
     """Get a specific overlay"""
     if overlays_collection is None:
-        return jsonify({"error": "Database not available"}), 503
+        return json_response({"error": "Database not available"}, 503)
+    
+    if not _OID_RE.match(overlay_id):
+        return json_response({"error": "Invalid overlay ID"}, 400)
     
     try:
-        overlay = overlays_collection.find_one({'_id': ObjectId(overlay_id)})
+        overlay = overlays_collection.find_one({'_id': ObjectId(overlay_id)}, OVERLAY_PROJECTION)
         
         if not overlay:
-            return jsonify({"error": "Overlay not found"}), 404
+            return json_response({"error": "Overlay not found"}, 404)
         
-        overlay['_id'] = str(overlay['_id'])
-        return jsonify(overlay), 200
+        merge_pending_overlay_updates([overlay])
+        return json_response(overlay, 200)
         
     except Exception as e:
         logger.error(f"Error fetching overlay: {e}")
-        return jsonify({"error": "Invalid overlay ID"}), 400
+        return json_response({"error": str(e)}, 500)
 
 @app.route('/api/overlays/<overlay_id>', methods=['PUT'])
 def update_overlay(overlay_id):
@@ -445,112 +829,124 @@ def update_overlay(overlay_id):
     
     # Validate overlay type if provided
     if 'type' in data and data['type'] not in ['text', 'image']:
-        return jsonify({"error": "Invalid overlay type"}), 400
+        return json_response({"error": "Invalid overlay type"}, 400)
     
     # Validate dimensions if provided
     if 'size' in data:
         if data['size']['width'] < 10 or data['size']['width'] > 2000:
-            return jsonify({"error": "Width must be between 10 and 2000"}), 400
+            return json_response({"error": "Width must be between 10 and 2000"}, 400)
         if data['size']['height'] < 10 or data['size']['height'] > 2000:
-            return jsonify({"error": "Height must be between 10 and 2000"}), 400
+            return json_response({"error": "Height must be between 10 and 2000"}, 400)
     
     if USE_MONGODB:
+        if not _OID_RE.match(overlay_id):
+            return json_response({"error": "Invalid overlay ID"}, 400)
+        
+        # Queue the change; the flush loop writes it within the flush interval
+        overlay_id = overlay_id.lower()
+        data.pop('_id', None)
+        data['updated_at'] = datetime.now(timezone.utc)
+        
+        # Reject values BSON can't hold (e.g. ints over 64 bits) here, since
+        # the write happens later where the client can't be told
         try:
-            # Add updated timestamp
-            data['updated_at'] = datetime.utcnow()
-            
-            result = overlays_collection.update_one(
-                {'_id': ObjectId(overlay_id)},
-                {'$set': data}
-            )
-            
-            if result.matched_count == 0:
-                return jsonify({"error": "Overlay not found"}), 404
-            
-            # Get updated overlay
-            overlay = overlays_collection.find_one({'_id': ObjectId(overlay_id)})
-            overlay['_id'] = str(overlay['_id'])
-            if 'created_at' in overlay and hasattr(overlay['created_at'], 'isoformat'):
-                overlay['created_at'] = overlay['created_at'].isoformat()
-            if 'updated_at' in overlay and hasattr(overlay['updated_at'], 'isoformat'):
-                overlay['updated_at'] = overlay['updated_at'].isoformat()
-            
-            logger.info(f"✏️ Overlay updated: {overlay_id}")
-            return jsonify(overlay), 200
-            
-        except Exception as e:
-            logger.error(f"Error updating overlay: {e}")
-            return jsonify({"error": "Invalid overlay ID"}), 400
+            encode_bson({'$set': data})
+        except (InvalidDocument, OverflowError) as e:
+            return json_response({"error": f"Invalid overlay data: {e}"}, 400)
+        
+        with _pending_lock:
+            pending = _pending_overlay_updates.setdefault(overlay_id, {})
+            pending.update(data)
+            overlay = {'_id': overlay_id, **_queued_fields(pending)}
+        
+        logger.info(f"✏️ Overlay update queued: {overlay_id}")
+        return json_response(overlay, 202)
     else:
         # Use in-memory storage
-        for overlay in in_memory_overlays:
-            if overlay['_id'] == overlay_id:
-                overlay.update(data)
-                overlay['updated_at'] = datetime.utcnow().isoformat()
-                logger.info(f"✏️ Overlay updated (in-memory): {overlay_id}")
-                return jsonify(overlay), 200
+        overlay = in_memory_overlays.get(overlay_id)
+        if overlay is None:
+            return json_response({"error": "Overlay not found"}, 404)
+        
+        # The store is keyed by _id, so it can't be changed
+        data.pop('_id', None)
         
-        return jsonify({"error": "Overlay not found"}), 404
+        overlay.update(data)
+        overlay['updated_at'] = format_timestamp(datetime.now(timezone.utc))
+        logger.info(f"✏️ Overlay updated (in-memory): {overlay_id}")
+        return json_response(overlay, 200)
 
 @app.route('/api/overlays/<overlay_id>', methods=['DELETE'])
 def delete_overlay(overlay_id):
     """Delete an overlay"""
     if USE_MONGODB:
+        if not _OID_RE.match(overlay_id):
+            return json_response({"error": "Invalid overlay ID"}, 400)
+        
+        with _pending_lock:
+            _pending_overlay_updates.pop(overlay_id.lower(), None)
+        
         try:
             result = overlays_collection.delete_one({'_id': ObjectId(overlay_id)})
             
             if result.deleted_count == 0:
-                return jsonify({"error": "Overlay not found"}), 404
+                return json_response({"error": "Overlay not found"}, 404)
             
             logger.info(f"🗑️ Overlay deleted: {overlay_id}")
-            return jsonify({"message": "Overlay deleted successfully"}), 200
+            return json_response({"message": "Overlay deleted successfully"}, 200)
             
         except Exception as e:
             logger.error(f"Error deleting overlay: {e}")
-            return jsonify({"error": "Invalid overlay ID"}), 400
+            return json_response({"error": str(e)}, 500)
     else:
         # Use in-memory storage
-        global in_memory_overlays
-        original_length = len(in_memory_overlays)
-        in_memory_overlays = [o for o in in_memory_overlays if o['_id'] != overlay_id]
-        
-        if len(in_memory_overlays) == original_length:
-            return jsonify({"error": "Overlay not found"}), 404
+        if in_memory_overlays.pop(overlay_id, None) is None:
+            return json_response({"error": "Overlay not found"}, 404)
         
         logger.info(f"🗑️ Overlay deleted (in-memory): {overlay_id}")
-        return jsonify({"message": "Overlay deleted successfully"}), 200
+        return json_response({"message": "Overlay deleted successfully"}, 200)
 
 @app.route('/api/overlays/bulk-delete', methods=['POST'])
 def bulk_delete_overlays():
     """Delete multiple overlays"""
     if overlays_collection is None:
-        return jsonify({"error": "Database not available"}), 503
+        return json_response({"error": "Database not available"}, 503)
     
     data = request.get_json()
     overlay_ids = data.get('overlay_ids', [])
     
     if not overlay_ids:
-        return jsonify({"error": "No overlay IDs provided"}), 400
+        return json_response({"error": "No overlay IDs provided"}, 400)
     
     try:
-        object_ids = [ObjectId(id) for id in overlay_ids]
-        result = overlays_collection.delete_many({'_id': {'$in': object_ids}})
+        # Delete in chunks to keep each command well under the 16 MB BSON
+        # limit; malformed IDs are skipped instead of failing the whole delete
+        deleted_count = 0
+        for i in range(0, len(overlay_ids), BULK_DELETE_CHUNK_SIZE):
+            object_ids = [ObjectId(id) for id in overlay_ids[i:i + BULK_DELETE_CHUNK_SIZE]
+                          if isinstance(id, str) and _OID_RE.match(id)]
+            if object_ids:
+                result = overlays_writes.delete_many({'_id': {'$in': object_ids}})
+                deleted_count += result.deleted_count
         
-        logger.info(f"🗑️ Bulk deleted {result.deleted_count} overlays")
-        return jsonify({
-            "message": f"Deleted {result.deleted_count} overlays",
-            "deleted_count": result.deleted_count
-        }), 200
+        logger.info(f"🗑️ Bulk deleted {deleted_count} overlays")
+        return json_response({
+            "message": f"Deleted {deleted_count} overlays",
+            "deleted_count": deleted_count
+        }, 200)
         
     except Exception as e:
         logger.error(f"Error bulk deleting overlays: {e}")
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
 
 # ==================== CLEANUP ====================
 def cleanup_streams():
     """Clean up all active streams on shutdown"""
     logger.info("🧹 Cleaning up active streams...")
-    for stream_id, info in list(active_streams.items()):
+    with _streams_lock:
+        streams = list(active_streams.items())
+        active_streams.clear()
+    
+    for stream_id, info in streams:
         try:
             process = info['process']
             process.terminate()
@@ -559,22 +955,52 @@ def cleanup_streams():
         except Exception as e:
             logger.error(f"Error stopping stream {stream_id}: {e}")
 
+def reap_dead_streams():
+    """Background loop: drop exited streams and expire old FFmpeg logs"""
+    while True:
+        time.sleep(STREAM_REAP_INTERVAL_SECONDS)
+        # Snapshot under the lock; poll() the processes outside it
+        with _streams_lock:
+            snapshot = list(active_streams.items())
+        
+        dead = [(stream_id, info) for stream_id, info in snapshot
+                if info['process'].poll() is not None]
+        with _streams_lock:
+            # Skip streams stopped (and removed) since the snapshot
+            dead = [stream_id for stream_id, info in dead
+                    if active_streams.get(stream_id) is info]
+            for stream_id in dead:
+                del active_streams[stream_id]
+        
+        for stream_id in dead:
+            shutil.rmtree(os.path.join(STREAMS_DIR, stream_id), ignore_errors=True)
+            logger.info(f"🧹 Reaped exited stream: {stream_id}")
+        
+        prune_ffmpeg_logs()
+
+threading.Thread(target=reap_dead_streams, daemon=True).start()
+
 def signal_handler(sig, frame):
     """Handle shutdown signals"""
     logger.info("🛑 Shutting down gracefully...")
+    flush_overlay_updates()
     cleanup_streams()
     sys.exit(0)
 
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
-
 # ==================== RUN SERVER ====================
+# Development entry point. In production run under gunicorn instead:
+#   gunicorn -c gunicorn.conf.py app:app
+# (gunicorn owns the signal handling there; see gunicorn.conf.py)
 if __name__ == '__main__':
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    
     logger.info("🚀 Starting RTSP Overlay Server...")
     logger.info(f"📁 Streams directory: {STREAMS_DIR}")
     
     try:
-        app.run(host='0.0.0.0', port=5000, debug=True)
+        app.run(host='0.0.0.0', port=5000, threaded=True)
     finally:
+        flush_overlay_updates()
         cleanup_streams()
 
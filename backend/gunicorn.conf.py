@@ -0,0 +1,34 @@
+# Gunicorn configuration for the RTSP Overlay backend
+# Usage (from the backend directory):
+#   gunicorn -c gunicorn.conf.py app:app
+import os
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '5000')}"
+
+# Threaded workers: HLS playlist/segment fetches and overlay API calls are
+# I/O-bound, so each request gets its own thread instead of queueing behind
+# a single-threaded dev server.
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '32'))
+
+# hls.js re-fetches the playlist every segment duration; keep connections
+# open long enough between fetches to be reused (gunicorn's default is 2s)
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+
+# Active FFmpeg processes are tracked in-process, so stream start/stop/status
+# only see the streams of the worker that handled the request. Keep a single
+# worker unless the streams are managed elsewhere.
+workers = int(os.getenv('GUNICORN_WORKERS', '1'))
+
+# Serve HLS segments from the page cache straight to the socket
+sendfile = True
+
+timeout = 30
+accesslog = '-'
+
+
+def worker_exit(server, worker):
+    """Write queued overlay updates and stop this worker's FFmpeg processes"""
+    from app import cleanup_streams, flush_overlay_updates
+    flush_overlay_updates()
+    cleanup_streams()